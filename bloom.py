@@ -0,0 +1,82 @@
+import hashlib
+import logging
+import math
+import os
+import struct
+
+logger = logging.getLogger(__name__)
+
+# 檔案標頭: 位元數、雜湊函數數量、已加入數量
+_HEADER = struct.Struct(">IIQ")
+
+
+class BloomFilter:
+    """固定大小的 Bloom filter，用於低成本判斷某個 key 是否曾經出現過
+
+    可能誤判為「已出現」（機率約為 error_rate），但不會漏判。
+    """
+
+    def __init__(self, capacity=100000, error_rate=0.001):
+        self.capacity = capacity
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _positions(self, key):
+        """以 double hashing 產生 key 對應的位元位置"""
+        digest = hashlib.sha256(key.encode("utf-8")).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, key):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def add(self, key):
+        """加入 key，回傳是否為新的 key"""
+        is_new = False
+        for p in self._positions(key):
+            mask = 1 << (p & 7)
+            if not self.bits[p >> 3] & mask:
+                self.bits[p >> 3] |= mask
+                is_new = True
+        if is_new:
+            self.count += 1
+            if self.count == self.capacity:
+                logger.warning(f"Bloom filter 已達容量上限 {self.capacity}，誤判率將開始上升")
+        return is_new
+
+    def save(self, path):
+        """保存到二進位檔案"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(_HEADER.pack(self.num_bits, self.num_hashes, self.count))
+            f.write(self.bits)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, capacity=100000, error_rate=0.001):
+        """從檔案載入，檔案不存在或損毀時建立新的 filter"""
+        bloom = cls(capacity, error_rate)
+        if not os.path.exists(path):
+            return bloom
+        try:
+            with open(path, 'rb') as f:
+                num_bits, num_hashes, count = _HEADER.unpack(f.read(_HEADER.size))
+                bits = bytearray(f.read())
+        except struct.error:
+            logger.error(f"無法解析 {path}，將建立新的 Bloom filter")
+            return bloom
+        if len(bits) != (num_bits + 7) // 8:
+            logger.error(f"{path} 大小不符，將建立新的 Bloom filter")
+            return bloom
+        # 沿用檔案中的參數，避免設定變更後舊資料失效
+        bloom.num_bits, bloom.num_hashes, bloom.count, bloom.bits = num_bits, num_hashes, count, bits
+        return bloom
@@ -1,4 +1,5 @@
 import os
+import socket
 from dotenv import load_dotenv
 
 # 加载环境变量
@@ -14,4 +15,50 @@ RECIPIENT_EMAIL = os.getenv("RECIPIENT_EMAIL")
 
 # 监控设置
 CHECK_INTERVAL_MINUTES = int(os.getenv("CHECK_INTERVAL_MINUTES", "30"))
-DATA_FILE = "seen_posts.json" 
\ No newline at end of file
+DATA_FILE = os.getenv("DATA_FILE", "seen_posts.json")
+
+# 搜尋索引設定
+SEARCH_INDEX_FILE = os.getenv("SEARCH_INDEX_FILE", "data/search_index.db")
+
+# 瀏覽器工作階段設定
+STORAGE_STATE_FILE = os.getenv("STORAGE_STATE_FILE", "data/storage_state.json")
+STORAGE_STATE_MAX_AGE_HOURS = int(os.getenv("STORAGE_STATE_MAX_AGE_HOURS", "24"))
+CLOUDFLARE_TIMEOUT_SECONDS = int(os.getenv("CLOUDFLARE_TIMEOUT_SECONDS", "30"))
+
+# 去重設定：只有時間窗口內的貼文參與相似度比對，較舊的貼文壓縮進 Bloom filter
+DEDUP_WINDOW_DAYS = int(os.getenv("DEDUP_WINDOW_DAYS", "7"))
+DEDUP_WINDOW_POSTS = int(os.getenv("DEDUP_WINDOW_POSTS", "500"))
+SEEN_FILTER_FILE = os.getenv("SEEN_FILTER_FILE", "data/seen_filter.bin")
+SEEN_FILTER_CAPACITY = int(os.getenv("SEEN_FILTER_CAPACITY", "1000000"))
+SEEN_FILTER_ERROR_RATE = float(os.getenv("SEEN_FILTER_ERROR_RATE", "0.001"))
+
+# 媒體快取設定
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", "data/media_cache")
+MEDIA_CACHE_MAX_MB = int(os.getenv("MEDIA_CACHE_MAX_MB", "200"))
+MEDIA_MAX_FILE_MB = int(os.getenv("MEDIA_MAX_FILE_MB", "10"))
+MEDIA_MAX_WORKERS = int(os.getenv("MEDIA_MAX_WORKERS", "4"))
+MEDIA_DOWNLOAD_TIMEOUT = int(os.getenv("MEDIA_DOWNLOAD_TIMEOUT", "20"))
+MEDIA_ATTACHMENT_MAX_MB = int(os.getenv("MEDIA_ATTACHMENT_MAX_MB", "15"))
+
+# 網路錄製/重播設定：live（直接連線）、record（錄製成 HAR）、replay（從 HAR 重播，不連網）
+NETWORK_MODE = os.getenv("NETWORK_MODE", "live")
+NETWORK_ARCHIVE = os.getenv("NETWORK_ARCHIVE", "data/network_session.har")
+NETWORK_PROFILE = os.getenv("NETWORK_PROFILE", "none")
+
+# 高可用設定：多個副本共用 data 目錄，以租約選出唯一負責抓取的副本
+HA_ENABLED = os.getenv("HA_ENABLED", "false").lower() in ("1", "true", "yes")
+HA_STATE_DB = os.getenv("HA_STATE_DB", "data/ha_state.db")
+HA_LEASE_SECONDS = int(os.getenv("HA_LEASE_SECONDS", "30"))
+REPLICA_ID = os.getenv("REPLICA_ID", socket.gethostname())
+
+# 檢查週期預算：超過預算加上寬限時間的週期會連同瀏覽器一併終止
+CYCLE_BUDGET_SECONDS = int(os.getenv("CYCLE_BUDGET_SECONDS", "900"))
+CYCLE_KILL_GRACE_SECONDS = int(os.getenv("CYCLE_KILL_GRACE_SECONDS", "30"))
+CYCLE_METRICS_FILE = os.getenv("CYCLE_METRICS_FILE", "data/cycle_metrics.json")
+
+# 通知摘要設定：合併窗口內的新貼文合併成一封郵件（0 表示每次檢查立即寄出）
+DIGEST_FILE = os.getenv("DIGEST_FILE", "data/pending_digest.json")
+DIGEST_WINDOW_MINUTES = int(os.getenv("DIGEST_WINDOW_MINUTES", "0"))
+DIGEST_MAX_ATTEMPTS = int(os.getenv("DIGEST_MAX_ATTEMPTS", "3"))
+DIGEST_FLUSH_BUDGET_SECONDS = int(os.getenv("DIGEST_FLUSH_BUDGET_SECONDS", "120"))
+DIGEST_FLUSH_METRICS_FILE = os.getenv("DIGEST_FLUSH_METRICS_FILE", "data/flush_metrics.json")
@@ -2,10 +2,12 @@ import json
 import logging
 import os
 import time
-import re
 from datetime import datetime
 from playwright.sync_api import sync_playwright
 
+import netreplay
+from search import PostIndex, tokenize
+
 # 設置日誌
 logging.basicConfig(
     level=logging.INFO,
@@ -28,8 +30,8 @@ def create_directories():
 def calculate_jaccard_similarity(str1, str2):
     """計算兩個字符串的 Jaccard 相似度"""
     # 將字符串轉換為單詞集合
-    set1 = set(re.findall(r'\w+', str1.lower()))
-    set2 = set(re.findall(r'\w+', str2.lower()))
+    set1 = set(tokenize(str1))
+    set2 = set(tokenize(str2))
     
     # 計算 Jaccard 相似度
     if not set1 or not set2:
@@ -58,7 +60,8 @@ def truth_social_crawler():
     try:
         with sync_playwright() as p:
             browser = p.chromium.launch(headless=False)
-            context = browser.new_context(
+            context = netreplay.new_context(
+                browser,
                 viewport={"width": 1920, "height": 1080},
                 user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
             )
@@ -108,6 +111,8 @@ def truth_social_crawler():
             with open(os.path.join(DEBUG_DIR, "final_page.html"), "w", encoding="utf-8") as f:
                 f.write(page.content())
             
+            # 先關閉 context，錄製模式才會寫出 HAR
+            context.close()
             browser.close()
             
             # 使用 Jaccard 相似度去重
@@ -119,6 +124,10 @@ def truth_social_crawler():
                     json.dump(unique_posts, f, ensure_ascii=False, indent=2)
                 
                 logger.info(f"成功保存 {len(unique_posts)} 個去重後的貼文到文件")
+                
+                # 將貼文加入搜尋索引
+                indexed = PostIndex().add_posts(unique_posts)
+                logger.info(f"已將 {indexed} 則貼文加入搜尋索引")
                 return unique_posts
             else:
                 logger.warning("未找到任何貼文")
@@ -183,8 +192,11 @@ def extract_posts_from_page(page, source_identifier):
             # 提取日期信息
             date_element = element.query_selector("time") or element.query_selector("[datetime]")
             post_date = "unknown"
+            published_at = None
             if date_element:
-                post_date = date_element.inner_text() or date_element.get_attribute("datetime") or "unknown"
+                # datetime 屬性是完整的發布時間，顯示文字通常只是「3h」之類的相對時間
+                published_at = date_element.get_attribute("datetime")
+                post_date = date_element.inner_text() or published_at or "unknown"
             
             # 清理文本內容
             clean_content = " ".join(text_content.split())
@@ -198,6 +210,7 @@ def extract_posts_from_page(page, source_identifier):
                 "id": f"{source_identifier}_post_{i}_{datetime.now().isoformat()}",
                 "content": clean_content,
                 "date": post_date,
+                "published_at": published_at,
                 "author": "@realDonaldTrump",
                 "selector_used": used_selector,
                 "source": source_identifier,
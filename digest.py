@@ -0,0 +1,120 @@
+import fcntl
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from config import DIGEST_FILE, DIGEST_MAX_ATTEMPTS, DIGEST_WINDOW_MINUTES
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def digest_lock(digest_file=DIGEST_FILE, blocking=True):
+    """取得摘要檔的獨占鎖，檢查行程與寄送行程不會同時讀寫摘要與媒體快取
+
+    非阻塞模式下若已被其他行程鎖定則回傳 False；行程被終止時鎖會自動釋放。
+    """
+    directory = os.path.dirname(digest_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(f"{digest_file}.lock", 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class NotificationDigest:
+    """等待合併寄出的貼文（持久化，跨檢查週期與副本共用）
+
+    第一則貼文加入後開始計時，合併窗口內陸續加入的貼文會合併成一封郵件。
+    已渲染的貼文 HTML 片段也一併保存，重寄時不需要重新渲染。
+    """
+
+    def __init__(self, digest_file=DIGEST_FILE, window_minutes=DIGEST_WINDOW_MINUTES):
+        self.digest_file = digest_file
+        self.window_seconds = window_minutes * 60
+        self.opened_at = None
+        self.attempts = 0
+        self.posts = []
+        self.fragments = {}
+        self._load()
+
+    def __len__(self):
+        return len(self.posts)
+
+    def _load(self):
+        """載入尚未寄出的摘要"""
+        if not os.path.exists(self.digest_file):
+            return
+        try:
+            with open(self.digest_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except json.JSONDecodeError:
+            logger.error(f"無法解析 {self.digest_file}，將建立新的摘要")
+            return
+        self.opened_at = data.get("opened_at")
+        self.attempts = data.get("attempts", 0)
+        self.posts = data.get("posts", [])
+        self.fragments = data.get("fragments", {})
+
+    def save(self):
+        """保存摘要，先寫入暫存檔再取代"""
+        directory = os.path.dirname(self.digest_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 只保留仍在佇列中的貼文片段
+        post_ids = {post.get("id") for post in self.posts}
+        self.fragments = {post_id: html for post_id, html in self.fragments.items() if post_id in post_ids}
+        tmp_file = f"{self.digest_file}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({
+                "opened_at": self.opened_at,
+                "attempts": self.attempts,
+                "posts": self.posts,
+                "fragments": self.fragments,
+            }, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, self.digest_file)
+
+    def add(self, posts):
+        """加入貼文，第一則貼文加入時開始計算合併窗口"""
+        if not posts:
+            return
+        if not self.posts:
+            self.opened_at = time.time()
+        queued = {post.get("id") for post in self.posts}
+        self.posts.extend(post for post in posts if post.get("id") not in queued)
+
+    def due_at(self):
+        """預計寄出的時間（epoch 秒），沒有貼文時為 None"""
+        if not self.posts:
+            return None
+        return (self.opened_at or 0) + self.window_seconds
+
+    def is_due(self):
+        """是否已到寄出時間"""
+        return bool(self.posts) and time.time() >= self.due_at()
+
+    def clear(self):
+        """寄出成功後清空摘要"""
+        self.posts = []
+        self.fragments = {}
+        self.opened_at = None
+        self.attempts = 0
+
+    def record_failure(self):
+        """記錄一次寄送失敗，超過重試上限時放棄並回傳被放棄的貼文"""
+        self.attempts += 1
+        if self.attempts < DIGEST_MAX_ATTEMPTS:
+            return []
+        logger.error(f"摘要已寄送失敗 {self.attempts} 次，放棄 {len(self.posts)} 則貼文")
+        dropped = self.posts
+        self.clear()
+        return dropped
@@ -0,0 +1,182 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from config import HA_LEASE_SECONDS, HA_STATE_DB
+
+logger = logging.getLogger(__name__)
+
+LEADER_LEASE = "fetcher"
+
+
+class SharedStateStore:
+    """多個副本共用的狀態（SQLite，放在共用的 data 目錄）
+
+    - leases: 誰是目前負責抓取的副本，過期後其他副本可以接手
+    - claims: 每則貼文的通知認領，確保同一則貼文只會寄出一封郵件
+    - meta: 其他共用的小型資料，例如上次完成檢查的時間
+    """
+
+    def __init__(self, db_file=HA_STATE_DB):
+        self.db_file = db_file
+        directory = os.path.dirname(db_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    holder TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS claims (
+                    key TEXT PRIMARY KEY,
+                    holder TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    claimed_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+            """)
+
+    def _connect(self):
+        """建立連線，每次操作使用新的連線以便跨執行緒/行程使用"""
+        return sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+
+    def acquire_lease(self, name, holder, ttl):
+        """取得或續約租約，回傳是否由 holder 持有"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT holder, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+            if row is None or row[0] == holder or row[1] < now:
+                conn.execute(
+                    "INSERT OR REPLACE INTO leases (name, holder, expires_at) VALUES (?, ?, ?)",
+                    (name, holder, now + ttl)
+                )
+                conn.execute("COMMIT")
+                return True
+            conn.execute("ROLLBACK")
+            return False
+        finally:
+            conn.close()
+
+    def release_lease(self, name, holder):
+        """主動釋放租約，讓其他副本立即接手"""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+    def is_lease_holder(self, name, holder):
+        """檢查 holder 是否仍持有未過期的租約"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT 1 FROM leases WHERE name = ? AND holder = ? AND expires_at >= ?",
+                (name, holder, time.time())
+            ).fetchone()
+        return row is not None
+
+    def claim_notification(self, key, holder, stale_after):
+        """認領一則貼文的通知，回傳是否認領成功
+
+        已寄出的貼文不能再認領；其他副本認領後超過 stale_after 秒仍未完成的，
+        視為該副本已失效，可以重新認領。
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT holder, status, claimed_at FROM claims WHERE key = ?", (key,)).fetchone()
+            if row is None or (row[1] == "pending" and (row[0] == holder or row[2] < now - stale_after)):
+                conn.execute(
+                    "INSERT OR REPLACE INTO claims (key, holder, status, claimed_at) VALUES (?, ?, 'pending', ?)",
+                    (key, holder, now)
+                )
+                conn.execute("COMMIT")
+                return True
+            conn.execute("ROLLBACK")
+            return False
+        finally:
+            conn.close()
+
+    def complete_claim(self, key):
+        """標記通知已寄出"""
+        with self._connect() as conn:
+            conn.execute("UPDATE claims SET status = 'sent' WHERE key = ?", (key,))
+
+    def release_claim(self, key):
+        """寄送失敗時釋放認領"""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM claims WHERE key = ? AND status = 'pending'", (key,))
+
+    def prune_claims(self, older_than):
+        """刪除超過 older_than 秒的已寄出認領，較舊的貼文由 Bloom filter 負責去重"""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM claims WHERE status = 'sent' AND claimed_at < ?", (time.time() - older_than,))
+
+    def get_meta(self, key, default=None):
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+
+class LeaderElector:
+    """在背景執行緒中持續續約，選出唯一負責抓取的副本"""
+
+    def __init__(self, store, holder, ttl=HA_LEASE_SECONDS):
+        self.store = store
+        self.holder = holder
+        self.ttl = ttl
+        self._leader = False
+        self._elected = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _renew(self):
+        """嘗試取得或續約租約，並記錄身分變化"""
+        try:
+            leader = self.store.acquire_lease(LEADER_LEASE, self.holder, self.ttl)
+        except sqlite3.Error as e:
+            logger.error(f"續約失敗: {str(e)}")
+            leader = False
+        if leader and not self._leader:
+            logger.info(f"副本 {self.holder} 成為主要抓取者")
+            self._elected.set()
+        elif not leader and self._leader:
+            logger.warning(f"副本 {self.holder} 失去主要抓取者身分，轉為待命")
+        self._leader = leader
+
+    def _run(self):
+        while not self._stop.wait(self.ttl / 3):
+            self._renew()
+
+    def start(self):
+        """先同步嘗試一次，再啟動背景續約"""
+        self._renew()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._leader:
+            self.store.release_lease(LEADER_LEASE, self.holder)
+            self._leader = False
+
+    @property
+    def is_leader(self):
+        """以資料庫中的租約為準，避免續約執行緒落後時誤判"""
+        return self.store.is_lease_holder(LEADER_LEASE, self.holder)
+
+    def consume_election(self):
+        """回傳自上次呼叫後是否剛成為主要抓取者"""
+        if self._elected.is_set():
+            self._elected.clear()
+            return True
+        return False
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from config import (MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_MB, MEDIA_DOWNLOAD_TIMEOUT,
+                    MEDIA_MAX_FILE_MB, MEDIA_MAX_WORKERS)
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"
+
+
+class MediaCache:
+    """以內容雜湊為 key 的媒體快取，超過容量時依最近使用時間淘汰
+
+    同一個網址只會下載一次；不同網址但內容相同的檔案只會保存一份。
+    """
+
+    def __init__(self, cache_dir=MEDIA_CACHE_DIR, max_bytes=MEDIA_CACHE_MAX_MB * 1024 * 1024,
+                 max_workers=MEDIA_MAX_WORKERS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_workers = max_workers
+        self.index_file = os.path.join(cache_dir, "index.json")
+        os.makedirs(cache_dir, exist_ok=True)
+        self.urls, self.files = self._load_index()
+
+    def _load_index(self):
+        """載入網址與檔案的對應表"""
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file, 'r', encoding='utf-8') as f:
+                    index = json.load(f)
+                return index.get("urls", {}), index.get("files", {})
+            except json.JSONDecodeError:
+                logger.error(f"無法解析 {self.index_file}，將建立新的媒體快取索引")
+        return {}, {}
+
+    def _save_index(self):
+        """儲存網址與檔案的對應表"""
+        tmp_file = f"{self.index_file}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({"urls": self.urls, "files": self.files}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, self.index_file)
+
+    def path(self, content_hash):
+        """取得快取檔案路徑"""
+        return os.path.join(self.cache_dir, content_hash + self.files[content_hash]["ext"])
+
+    def get(self, content_hash):
+        """讀取快取檔案，回傳 (內容, content type)，不存在則回傳 None"""
+        if content_hash not in self.files or not os.path.exists(self.path(content_hash)):
+            return None
+        self.files[content_hash]["last_used"] = time.time()
+        with open(self.path(content_hash), 'rb') as f:
+            return f.read(), self.files[content_hash]["content_type"]
+
+    def _lookup(self, url):
+        """查詢網址是否已有快取檔案"""
+        content_hash = self.urls.get(url)
+        if content_hash and content_hash in self.files and os.path.exists(self.path(content_hash)):
+            return content_hash
+        return None
+
+    def _download(self, url):
+        """下載單一檔案，超過大小上限則放棄"""
+        max_bytes = MEDIA_MAX_FILE_MB * 1024 * 1024
+        request = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
+        with urllib.request.urlopen(request, timeout=MEDIA_DOWNLOAD_TIMEOUT) as response:
+            data = response.read(max_bytes + 1)
+            content_type = response.headers.get_content_type()
+        if len(data) > max_bytes:
+            raise ValueError(f"檔案超過 {MEDIA_MAX_FILE_MB} MB")
+        return data, content_type
+
+    def _store(self, url, data, content_type):
+        """以內容雜湊保存檔案"""
+        content_hash = hashlib.sha256(data).hexdigest()
+        if content_hash not in self.files:
+            ext = mimetypes.guess_extension(content_type) or ""
+            self.files[content_hash] = {"size": len(data), "content_type": content_type, "ext": ext}
+            with open(self.path(content_hash), 'wb') as f:
+                f.write(data)
+        self.files[content_hash]["last_used"] = time.time()
+        self.urls[url] = content_hash
+        return content_hash
+
+    def _remove_orphans(self):
+        """刪除索引中沒有記錄的檔案（例如索引曾被其他行程覆寫），避免佔用空間卻不計入容量"""
+        known = {content_hash + info["ext"] for content_hash, info in self.files.items()}
+        for name in os.listdir(self.cache_dir):
+            if name.startswith("index.json") or name in known:
+                continue
+            os.remove(os.path.join(self.cache_dir, name))
+            logger.info(f"刪除媒體快取中未記錄的檔案 {name}")
+    
+    def _evict(self):
+        """刪除最久未使用的檔案，直到總大小低於上限"""
+        self._remove_orphans()
+        total = sum(info["size"] for info in self.files.values())
+        if total <= self.max_bytes:
+            return
+        evicted = set()
+        for content_hash, info in sorted(self.files.items(), key=lambda item: item[1].get("last_used", 0)):
+            if total <= self.max_bytes:
+                break
+            if os.path.exists(self.path(content_hash)):
+                os.remove(self.path(content_hash))
+            total -= info["size"]
+            evicted.add(content_hash)
+        for content_hash in evicted:
+            del self.files[content_hash]
+        self.urls = {url: h for url, h in self.urls.items() if h not in evicted}
+        logger.info(f"媒體快取淘汰 {len(evicted)} 個檔案")
+
+    def fetch_all(self, urls):
+        """並行下載尚未快取的網址，回傳 {網址: 內容雜湊}，下載失敗的網址不會出現在結果中
+
+        會改寫索引檔，多個行程使用時由呼叫端負責互斥（monitor 以摘要鎖保護）。
+        """
+        # 重新載入索引，納入其他行程下載的檔案，避免重複下載或覆寫其他行程的記錄
+        self.urls, self.files = self._load_index()
+        results = {}
+        pending = []
+        for url in dict.fromkeys(urls):
+            content_hash = self._lookup(url)
+            if content_hash:
+                self.files[content_hash]["last_used"] = time.time()
+                results[url] = content_hash
+            else:
+                pending.append(url)
+
+        if pending:
+            hits = len(results)
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {executor.submit(self._download, url): url for url in pending}
+                for future in as_completed(futures):
+                    url = futures[future]
+                    try:
+                        data, content_type = future.result()
+                        results[url] = self._store(url, data, content_type)
+                    except Exception as e:
+                        logger.error(f"下載媒體失敗 {url}: {str(e)}")
+            logger.info(f"媒體快取: {hits} 個命中，下載 {len(pending)} 個")
+
+        self._evict()
+        self._save_index()
+        return {url: content_hash for url, content_hash in results.items() if content_hash in self.files}
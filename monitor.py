@@ -3,8 +3,9 @@ import logging
 import os
 import smtplib
 import time
-import re
-from datetime import datetime
+from datetime import datetime, timedelta
+from email import encoders
+from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from pathlib import Path
@@ -12,10 +13,25 @@ import urllib.parse
 import random
 
 import schedule
+from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
 from playwright.sync_api import sync_playwright
 
-from config import (CHECK_INTERVAL_MINUTES, DATA_FILE, GMAIL_PASSWORD,
-                   GMAIL_USER, RECIPIENT_EMAIL, TRUTH_SOCIAL_URL)
+from config import (CHECK_INTERVAL_MINUTES, CLOUDFLARE_TIMEOUT_SECONDS,
+                   DATA_FILE, DEDUP_WINDOW_DAYS, DEDUP_WINDOW_POSTS,
+                   DIGEST_FLUSH_BUDGET_SECONDS, DIGEST_FLUSH_METRICS_FILE,
+                   DIGEST_WINDOW_MINUTES,
+                   GMAIL_PASSWORD, GMAIL_USER, HA_ENABLED, HA_LEASE_SECONDS,
+                   MEDIA_ATTACHMENT_MAX_MB, RECIPIENT_EMAIL, REPLICA_ID,
+                   SEEN_FILTER_CAPACITY, SEEN_FILTER_ERROR_RATE,
+                   SEEN_FILTER_FILE, STORAGE_STATE_FILE,
+                   STORAGE_STATE_MAX_AGE_HOURS, TRUTH_SOCIAL_URL)
+import netreplay
+from bloom import BloomFilter
+from digest import NotificationDigest, digest_lock
+from ha import LEADER_LEASE, LeaderElector, SharedStateStore
+from media import MediaCache
+from supervisor import CycleBudget, CycleSupervisor
+from search import PostIndex, content_key, tokenize
 
 # 設定日誌
 logging.basicConfig(
@@ -29,11 +45,32 @@ logger = logging.getLogger(__name__)
 DEBUG_DIR = "debug"
 DATA_DIR = "data"  # 資料儲存目錄
 
+# 文字少於此長度且帶有媒體的貼文視為純媒體貼文（比方說純影片的內容）
+MIN_TEXT_LENGTH = 100
+
+# ChatGPT 連結的長度上限
+CHATGPT_URL_MAX_LENGTH = 8121
+
+# 變更時才需要重新保存工作階段的 cookie（Cloudflare 通行證與網站登入工作階段）；
+# __cf_bm 與分析用 cookie 幾乎每次造訪都會換新，不列入比較
+SESSION_COOKIES = ("cf_clearance", "_session_id", "_mastodon_session")
+
 class TruthSocialMonitor:
     def __init__(self):
         self.data_file = DATA_FILE
-        self.seen_posts = self._load_seen_posts()
         self._create_directories()
+        # 高可用模式下與其他副本共用的狀態
+        self.state_store = SharedStateStore() if HA_ENABLED else None
+        self._load_dedup_state()
+        # 共用狀態只由主要抓取者寫入
+        if not self.state_store and self._compact_seen_posts():
+            self._save_seen_posts()
+        # 載入搜尋索引
+        self.search_index = PostIndex()
+        # 媒體快取
+        self.media_cache = MediaCache()
+        # 目前檢查週期的時間預算（未受監督執行時為 None）
+        self.cycle_budget = None
         # 載入收件人清單
         self.recipients = self._load_recipients()
         logger.info(f"已載入 {len(self.recipients)} 個收件人: {', '.join(self.recipients)}")
@@ -45,6 +82,12 @@ class TruthSocialMonitor:
                 os.makedirs(directory)
                 logger.info(f"建立目錄: {directory}")
     
+    def _load_dedup_state(self):
+        """載入去重狀態：窗口內的已通知貼文，以及較舊貼文的 Bloom filter"""
+        self.seen_posts = self._load_seen_posts()
+        # 較舊的貼文只保留在 Bloom filter 中做精確比對
+        self.seen_filter = BloomFilter.load(SEEN_FILTER_FILE, SEEN_FILTER_CAPACITY, SEEN_FILTER_ERROR_RATE)
+    
     def _load_seen_posts(self):
         """載入已經發送通知的貼文ID"""
         if os.path.exists(self.data_file):
@@ -58,14 +101,190 @@ class TruthSocialMonitor:
     
     def _save_seen_posts(self):
         """儲存已經發送通知的貼文ID"""
-        with open(self.data_file, 'w', encoding='utf-8') as f:
+        # 先寫入暫存檔再取代，避免其他副本讀到寫到一半的檔案
+        tmp_file = f"{self.data_file}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
             json.dump(self.seen_posts, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, self.data_file)
+    
+    def _is_active(self):
+        """是否由本副本負責抓取與通知（未啟用高可用模式時永遠為是）"""
+        return self.state_store is None or self.state_store.is_lease_holder(LEADER_LEASE, REPLICA_ID)
+    
+    def _notification_key(self, post):
+        """產生跨副本一致的通知 key
+
+        貼文ID每次抓取都不同，內容也含有「1h」之類會變動的相對時間，
+        因此優先使用 <time datetime> 發布時間與作者；沒有發布時間時才以媒體或內容計算。
+        """
+        if post.get("published_at"):
+            return f"post:{post.get('author', '')}:{post['published_at']}"
+        if self._is_media_only(post):
+            return "media:" + content_key(" ".join(sorted(self._media_keys(post))))
+        return self._content_hash(post.get("content", ""))
+    
+    def _claim_posts(self, posts):
+        """向共用狀態認領貼文通知，只回傳由本副本認領成功的貼文"""
+        # 抓取期間租約可能已過期並由其他副本接手
+        if not self._is_active():
+            logger.warning("抓取期間失去主要抓取者身分，不發送通知")
+            return []
+        claimed = []
+        for post in posts:
+            if self.state_store.claim_notification(self._notification_key(post), REPLICA_ID, HA_LEASE_SECONDS):
+                claimed.append(post)
+            else:
+                logger.info(f"貼文已由其他副本通知: {post.get('content', '')[:50]}...")
+        return claimed
+    
+    def _seen_at(self, post_info):
+        """取得已記錄貼文的通知或略過時間"""
+        for key in ("notified_at", "skipped_at"):
+            try:
+                return datetime.fromisoformat(post_info.get(key, ""))
+            except (TypeError, ValueError):
+                continue
+        return datetime.min
+    
+    def _content_hash(self, content):
+        """計算去除互動數字後的內容雜湊，用於精確比對舊貼文"""
+        return content_key(self._clean_content(content))
+    
+    def _compact_seen_posts(self):
+        """將超出去重窗口的貼文移入 Bloom filter，回傳移出的數量"""
+        ordered = sorted(self.seen_posts.items(), key=lambda item: self._seen_at(item[1]), reverse=True)
+        cutoff = datetime.now() - timedelta(days=DEDUP_WINDOW_DAYS) if DEDUP_WINDOW_DAYS > 0 else None
+        
+        # 只有已通知的貼文計入 DEDUP_WINDOW_POSTS；略過的相似貼文
+        # 比窗口內最舊的已通知貼文更舊時一併移出
+        expired = []
+        notified = 0
+        for post_id, post_info in ordered:
+            window_full = DEDUP_WINDOW_POSTS > 0 and notified >= DEDUP_WINDOW_POSTS
+            if window_full or (cutoff and self._seen_at(post_info) < cutoff):
+                expired.append(post_id)
+            elif post_info.get("notified_at") != "skipped_similar":
+                notified += 1
+        
+        if not expired:
+            return 0
+        
+        for post_id in expired:
+            post_info = self.seen_posts.pop(post_id)
+            self.seen_filter.add(self._content_hash(post_info.get("content", "")))
+            for key in self._media_keys(post_info):
+                self.seen_filter.add(f"media:{key}")
+        self.seen_filter.save(SEEN_FILTER_FILE)
+        logger.info(f"已將 {len(expired)} 個超出去重窗口的貼文壓縮進 Bloom filter，保留 {len(self.seen_posts)} 個")
+        return len(expired)
+    
+    def _load_storage_state(self):
+        """載入上次保存的瀏覽器工作階段（cookies 與 localStorage）"""
+        # 重播模式不使用正式的工作階段
+        if netreplay.is_replaying() or not os.path.exists(STORAGE_STATE_FILE):
+            return None
+        try:
+            with open(STORAGE_STATE_FILE, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except json.JSONDecodeError:
+            logger.error(f"無法解析 {STORAGE_STATE_FILE}，將建立新的工作階段")
+            return None
+        
+        if self._is_storage_state_expired(state):
+            logger.info("已保存的工作階段已過期，將建立新的工作階段")
+            return None
+        
+        logger.info(f"還原已保存的工作階段，共 {len(state.get('cookies', []))} 個 cookie")
+        return state
+    
+    def _is_storage_state_expired(self, state):
+        """依 cookie 的 expires 檢查工作階段是否過期
+
+        Cloudflare 通行 cookie 或所有持久 cookie 過期即視為過期；
+        只有 session cookie 時無法得知期限，改以上次保存後超過 STORAGE_STATE_MAX_AGE_HOURS 為準。
+        """
+        now = time.time()
+        cookies = state.get("cookies", [])
+        if not cookies:
+            return True
+        # expires 為 -1 表示瀏覽器關閉即失效的 session cookie
+        persistent = [cookie for cookie in cookies if cookie.get("expires", -1) > 0]
+        for cookie in persistent:
+            if cookie.get("name") == "cf_clearance" and cookie["expires"] < now:
+                return True
+        if not persistent:
+            age_hours = (now - os.path.getmtime(STORAGE_STATE_FILE)) / 3600
+            return age_hours > STORAGE_STATE_MAX_AGE_HOURS
+        return all(cookie["expires"] < now for cookie in persistent)
+    
+    def _cookies_changed(self, context, state):
+        """比較通行證與工作階段 cookie 的值是否與還原時不同（例如 cf_clearance 已被更新）"""
+        def cookie_keys(cookies):
+            return {(c.get("name"), c.get("domain"), c.get("value"))
+                    for c in cookies if c.get("name") in SESSION_COOKIES}
+        try:
+            return cookie_keys(context.cookies()) != cookie_keys(state.get("cookies", []))
+        except Exception as e:
+            logger.error(f"讀取 cookies 失敗: {str(e)}")
+            return False
+    
+    def _save_storage_state(self, context):
+        """保存目前的瀏覽器工作階段，供下次建立 context 時還原"""
+        if netreplay.is_replaying():
+            return
+        try:
+            context.storage_state(path=STORAGE_STATE_FILE)
+            logger.info(f"已保存工作階段到 {STORAGE_STATE_FILE}")
+        except Exception as e:
+            logger.error(f"保存工作階段失敗: {str(e)}")
+    
+    def _discard_storage_state(self):
+        """刪除已失效的工作階段"""
+        if not netreplay.is_replaying() and os.path.exists(STORAGE_STATE_FILE):
+            os.remove(STORAGE_STATE_FILE)
+            logger.info("已刪除失效的工作階段")
+    
+    def _enter_phase(self, phase, page=None):
+        """進入檢查週期的新階段，並依剩餘預算設定頁面的預設逾時"""
+        if self.cycle_budget is None:
+            return
+        self.cycle_budget.enter(phase)
+        if page:
+            page.set_default_timeout(self.cycle_budget.timeout_ms())
+    
+    def _timeout_ms(self, default_ms):
+        """取得不超過目前階段剩餘預算的逾時時間"""
+        if self.cycle_budget is None:
+            return default_ms
+        return min(default_ms, self.cycle_budget.timeout_ms())
+    
+    def _is_cloudflare_challenge(self, page):
+        """檢查目前頁面是否為 Cloudflare 挑戰頁面"""
+        title = page.title()
+        return "Cloudflare" in title or "Just a moment" in title
+    
+    def _wait_for_cloudflare_clearance(self, page):
+        """等待 Cloudflare 挑戰完成，頁面標題改變即視為通過"""
+        try:
+            page.wait_for_function(
+                "() => !document.title.includes('Cloudflare') && !document.title.includes('Just a moment')",
+                timeout=self._timeout_ms(CLOUDFLARE_TIMEOUT_SECONDS * 1000)
+            )
+        except PlaywrightTimeoutError:
+            return False
+        
+        # 通過挑戰後會重新導向，等待新頁面載入
+        try:
+            page.wait_for_load_state("networkidle", timeout=self._timeout_ms(CLOUDFLARE_TIMEOUT_SECONDS * 1000))
+        except PlaywrightTimeoutError:
+            pass
+        return True
     
     def _calculate_jaccard_similarity(self, str1, str2):
         """計算兩個字串的 Jaccard 相似度"""
         # 將字符串轉換為單詞集合
-        set1 = set(re.findall(r'\w+', str1.lower()))
-        set2 = set(re.findall(r'\w+', str2.lower()))
+        set1 = set(tokenize(str1))
+        set2 = set(tokenize(str2))
         
         # 計算 Jaccard 相似度
         if not set1 or not set2:
@@ -76,18 +295,28 @@ class TruthSocialMonitor:
         
         return intersection / union if union > 0 else 0
 
-    def _is_similar_content(self, new_content, existing_contents, threshold=0.7):
-        def _clean_content(_content: str):
-            tokens = _content.split(" ")
-            if len(tokens) > 3:
-                return " ".join(tokens[:-3])
-            else:
-                return _content
-        new_content = _clean_content(new_content)
+    def _clean_content(self, content):
+        """去除結尾的互動數字（回覆、轉發、按讚）"""
+        tokens = content.split(" ")
+        if len(tokens) > 3:
+            return " ".join(tokens[:-3])
+        else:
+            return content
 
+    def _media_keys(self, post):
+        """取得貼文媒體的比對 key（去除查詢參數的網址）"""
+        return {media["url"].split("?")[0] for media in post.get("media", [])}
+    
+    def _is_media_only(self, post):
+        """檢查是否為幾乎沒有文字的純媒體貼文"""
+        return bool(post.get("media")) and len(post.get("content", "")) < MIN_TEXT_LENGTH
+    
+    def _is_similar_content(self, new_content, existing_contents, threshold=0.7):
         """檢查新內容是否與現有內容相似"""
+        new_content = self._clean_content(new_content)
+
         for content in existing_contents:
-            content = _clean_content(content)
+            content = self._clean_content(content)
             similarity = self._calculate_jaccard_similarity(new_content, content)
             if similarity >= threshold:
                 return True
@@ -129,9 +358,10 @@ class TruthSocialMonitor:
             try:
                 # 擷取元素內容
                 text_content = element.inner_text().strip()
+                media = self._extract_media_from_element(element)
                 
-                # 只處理足夠長的內容，這可能是一個實際貼文
-                if len(text_content) < 50:
+                # 只處理足夠長或帶有媒體的內容，這可能是一個實際貼文
+                if len(text_content) < 50 and not media:
                     continue
                 
                 # 只關注特定使用者的貼文
@@ -148,8 +378,11 @@ class TruthSocialMonitor:
                 # 提取日期信息
                 date_element = element.query_selector("time") or element.query_selector("[datetime]")
                 post_date = "unknown"
+                published_at = None
                 if date_element:
-                    post_date = date_element.inner_text() or date_element.get_attribute("datetime") or "unknown"
+                    # datetime 屬性是完整的發布時間，顯示文字通常只是「3h」之類的相對時間
+                    published_at = date_element.get_attribute("datetime")
+                    post_date = date_element.inner_text() or published_at or "unknown"
                 
                 # 清理文本內容
                 clean_content = " ".join(text_content.split())
@@ -162,7 +395,9 @@ class TruthSocialMonitor:
                 posts.append({
                     "id": f"{source_identifier}_post_{i}_{datetime.now().isoformat()}",
                     "content": clean_content,
+                    "media": media,
                     "date": post_date,
+                    "published_at": published_at,
                     "author": "@realDonaldTrump",
                     "selector_used": used_selector,
                     "source": source_identifier,
@@ -175,13 +410,50 @@ class TruthSocialMonitor:
         
         return posts
 
+    def _extract_media_from_element(self, element):
+        """擷取貼文中的圖片與影片，回傳原始網址與預覽圖網址"""
+        raw_media = element.eval_on_selector_all("img, video", """
+            els => els.map(el => el.tagName === 'VIDEO'
+                ? {url: el.currentSrc || el.src, preview: el.poster}
+                : {url: el.currentSrc || el.src, preview: el.currentSrc || el.src})
+        """)
+        
+        media = []
+        seen_urls = set()
+        for item in raw_media:
+            preview = item.get("preview") or ""
+            url = item.get("url") or ""
+            # 串流影片的 blob 網址無法在郵件中使用，改用預覽圖
+            if not url.startswith("http"):
+                url = preview
+            if not url.startswith("http") or url in seen_urls:
+                continue
+            # 略過頭像與表情符號
+            if "avatar" in url or "emoji" in url:
+                continue
+            seen_urls.add(url)
+            media.append({"url": url, "preview": preview if preview.startswith("http") else ""})
+        return media
+
     def _remove_duplicates_using_jaccard(self, posts, similarity_threshold=0.7):
         """使用 Jaccard 相似度去除重複貼文"""
         unique_posts = []
         existing_contents = []
+        existing_media = set()
         
         for post in posts:
             content = post.get("content", "").lower()
+            media_keys = self._media_keys(post)
+            
+            # 純媒體貼文的文字只有作者資訊，改用媒體網址判斷是否重複
+            if self._is_media_only(post):
+                if media_keys <= existing_media:
+                    logger.info(f"發現重複媒體貼文: {content[:50]}...")
+                else:
+                    existing_media.update(media_keys)
+                    unique_posts.append(post)
+                    logger.info(f"添加唯一媒體貼文: {content[:50]}...")
+                continue
             
             # 跳過太短的內容
             if len(content) < 20:
@@ -198,31 +470,98 @@ class TruthSocialMonitor:
         logger.info(f"使用 Jaccard 相似度去重: 從 {len(posts)} 個貼文減少到 {len(unique_posts)} 個")
         return unique_posts
     
-    def send_notification(self, posts):
-        """通過Gmail發送通知，將多個貼文整合到一封郵件中"""
+    def _encode_post_chunks(self, posts):
+        """將每則貼文的文字各編碼一次，供摘要與翻譯連結共用"""
+        chunks = []
+        for post in posts:
+            text = f"日期: {post.get('date', 'unknown')}\n內容: {post.get('content', '')}\n\n"
+            chunks.append((text, urllib.parse.quote(text)))
+        return chunks
+    
+    def _build_chatgpt_url(self, prompt, chunks):
+        """產生不超過長度上限的 ChatGPT 連結，放不下的貼文整則略過，回傳 (網址, 包含的貼文數)"""
+        url = f"https://chatgpt.com/?q={urllib.parse.quote(prompt)}"
+        included = 0
+        for text, encoded in chunks:
+            if len(url) + len(encoded) > CHATGPT_URL_MAX_LENGTH:
+                break
+            url += encoded
+            included += 1
+        
+        if included == 0 and chunks:
+            # 第一則貼文就超過上限時，截斷原始文字而不是編碼後的字串，避免切斷跳脫序列
+            text = chunks[0][0]
+            low, high = 0, len(text)
+            while low < high:
+                mid = (low + high + 1) // 2
+                if len(url) + len(urllib.parse.quote(text[:mid])) <= CHATGPT_URL_MAX_LENGTH:
+                    low = mid
+                else:
+                    high = mid - 1
+            url += urllib.parse.quote(text[:low])
+            included = 1
+        return url, included
+    
+    def _render_post_fragment(self, post, cached_media, inline=True):
+        """產生單則貼文的 HTML 片段，回傳 HTML 與內嵌圖片的 Content-ID"""
+        cids = []
+        html = f"""
+                    <p><strong>發布時間:</strong> {post.get('date', 'unknown')}</p>
+                    <p><strong>內容:</strong></p>
+                    <blockquote style="background-color: #f9f9f9; padding: 10px; border-left: 4px solid #ccc;">
+                        {post.get('content', '')}
+                    </blockquote>
+        """
+        
+        media_list = post.get("media", [])
+        if media_list:
+            html += '<p><strong>媒體:</strong></p>'
+        for media in media_list:
+            content_hash = cached_media.get(media.get("preview")) if inline else None
+            info = self.media_cache.files.get(content_hash) if content_hash else None
+            if info and info["content_type"].startswith("image/"):
+                cids.append(content_hash)
+                html += f"""
+                    <a href="{media['url']}" target="_blank"><img src="cid:{content_hash}" style="max-width: 100%; margin: 5px 0;"></a>
+                """
+            else:
+                html += f"""
+                    <p><a href="{media['url']}" target="_blank">{media['url']}</a></p>
+                """
+        return {"html": html, "cids": cids}
+    
+    def send_notification(self, posts, fragments):
+        """通過Gmail發送通知，將多個貼文整合到一封郵件中
+
+        fragments 為摘要中保存的已渲染貼文片段（以貼文ID為 key），新渲染的片段會寫回其中，重寄時直接沿用。
+        """
         try:
             if not posts:
                 logger.info("沒有新貼文需要發送通知")
                 return False
             
-            # 準備所有貼文的內容，用於ChatGPT摘要和翻譯
-            all_post_contents = ""
-            for post in posts:
-                post_date = post.get('date', 'unknown')
-                post_content = post.get('content', '')
-                all_post_contents += f"日期: {post_date}\n內容: {post_content}\n\n"
-            
-            # URL編碼所有貼文內容
-            encoded_content = urllib.parse.quote(all_post_contents)
+            # 重播模式完全離線：不下載媒體（urllib 不經過 Playwright 的重播），也不寄出郵件
+            if netreplay.is_replaying():
+                logger.info(f"重播模式，略過 {len(posts)} 則貼文的通知郵件與媒體下載")
+                return True
             
-            # 創建ChatGPT摘要和翻譯的URL
-            summary_prompt = "請用繁體中文摘要以下內容:"
-            translation_prompt = "請將以下的貼文內容翻譯成繁體中文:"
+            # 每則貼文只編碼一次，連結放不下時整則略過
+            chunks = self._encode_post_chunks(posts)
+            summary_url, summary_count = self._build_chatgpt_url("請用繁體中文摘要以下內容:", chunks)
+            translation_url, translation_count = self._build_chatgpt_url("請將以下的貼文內容翻譯成繁體中文:", chunks)
+            link_note = ""
+            if min(summary_count, translation_count) < len(posts):
+                link_note = f"<p style=\"font-size: 12px; color: #666;\">因連結長度限制，ChatGPT 連結只包含前 {min(summary_count, translation_count)} 則貼文</p>"
             
-            summary_url = f"https://chatgpt.com/?q={urllib.parse.quote(summary_prompt)}{encoded_content}"
-            translation_url = f"https://chatgpt.com/?q={urllib.parse.quote(translation_prompt)}{encoded_content}"
-            summary_url = summary_url[:8121]
-            translation_url = translation_url[:8121]
+            # 只為尚未渲染的貼文下載媒體預覽圖（已快取的不會重複下載）
+            preview_urls = [
+                media["preview"]
+                for post in posts if post.get("id") not in fragments
+                for media in post.get("media", []) if media.get("preview")
+            ]
+            cached_media = self.media_cache.fetch_all(preview_urls) if preview_urls else {}
+            attachments = {}
+            max_bytes = MEDIA_ATTACHMENT_MAX_MB * 1024 * 1024
             
             msg = MIMEMultipart()
             msg['From'] = f'Trump Truth Social Monitor'
@@ -238,25 +577,38 @@ class TruthSocialMonitor:
                     <p>快速功能:</p>
                     <p><a href="{summary_url}" target="_blank" style="display: inline-block; margin-right: 15px; padding: 8px 15px; background-color: #4CAF50; color: white; text-decoration: none; border-radius: 4px;">由ChatGPT摘要</a>
                     <a href="{translation_url}" target="_blank" style="display: inline-block; padding: 8px 15px; background-color: #2196F3; color: white; text-decoration: none; border-radius: 4px;">由ChatGPT翻譯</a></p>
+                    {link_note}
                 </div>
                 <p>發現 {len(posts)} 則新貼文:</p>
             """
             
             # 添加每一則貼文
+            rendered = 0
             for i, post in enumerate(posts, 1):
-                post_date = post.get('date', 'unknown')
-                post_content = post.get('content', '')
+                post_id = post.get("id")
+                fragment = fragments.get(post_id)
+                if fragment is None:
+                    fragment = self._render_post_fragment(post, cached_media)
+                    fragments[post_id] = fragment
+                    rendered += 1
+                
+                # 內嵌圖片已被淘汰或超過附件上限時，改用只有連結的版本
+                needed = {cid: self.media_cache.get(cid) for cid in fragment["cids"] if cid not in attachments}
+                attached_bytes = sum(len(data) for data, _ in attachments.values())
+                needed_bytes = sum(len(item[0]) for item in needed.values() if item)
+                if any(item is None for item in needed.values()) or attached_bytes + needed_bytes > max_bytes:
+                    html = self._render_post_fragment(post, {}, inline=False)["html"]
+                else:
+                    attachments.update(needed)
+                    html = fragment["html"]
                 
                 body += f"""
                 <div style="margin-bottom: 20px; padding: 10px; border: 1px solid #ddd; border-radius: 5px;">
                     <h3>貼文 {i}</h3>
-                    <p><strong>發布時間:</strong> {post_date}</p>
-                    <p><strong>內容:</strong></p>
-                    <blockquote style="background-color: #f9f9f9; padding: 10px; border-left: 4px solid #ccc;">
-                        {post_content}
-                    </blockquote>
+                    {html}
                 </div>
                 """
+            logger.info(f"渲染 {rendered} 則貼文，沿用 {len(posts) - rendered} 則已渲染的貼文")
             
             body += f"""
                 <p><a href="{TRUTH_SOCIAL_URL}">查看更多 Truth Social 內容</a></p>
@@ -264,9 +616,22 @@ class TruthSocialMonitor:
             </html>
             """
             
-            msg.attach(MIMEText(body, 'html'))
+            # HTML 與內嵌圖片放在 multipart/related 中，郵件客戶端才會以 cid: 顯示圖片
+            related = MIMEMultipart('related')
+            related.attach(MIMEText(body, 'html'))
+            
+            # 以 Content-ID 內嵌圖片，同一個檔案只附加一次
+            for content_hash, (data, content_type) in attachments.items():
+                maintype, subtype = content_type.split("/", 1)
+                part = MIMEBase(maintype, subtype)
+                part.set_payload(data)
+                encoders.encode_base64(part)
+                part.add_header('Content-ID', f'<{content_hash}>')
+                part.add_header('Content-Disposition', 'inline', filename=f'{content_hash[:12]}.{subtype}')
+                related.attach(part)
+            msg.attach(related)
             
-            server = smtplib.SMTP('smtp.gmail.com', 587)
+            server = smtplib.SMTP('smtp.gmail.com', 587, timeout=self._timeout_ms(60000) / 1000)
             server.starttls()
             server.login(GMAIL_USER, GMAIL_PASSWORD)
             server.sendmail(GMAIL_USER, self.recipients, msg.as_string())
@@ -278,15 +643,53 @@ class TruthSocialMonitor:
             logger.error(f"發送email失敗: {str(e)}")
             return False
     
+    def flush_digest(self):
+        """寄出已到期的通知摘要，回傳是否寄出"""
+        if not self._is_active():
+            return False
+        
+        with digest_lock(blocking=False) as acquired:
+            # 另一個行程正在寄送時由它負責，尚未寄出的貼文會留在摘要中
+            if not acquired:
+                logger.info("另一個行程正在寄送摘要，略過本次寄送")
+                return False
+            
+            digest = NotificationDigest()
+            if not digest.is_due():
+                return False
+            
+            # 重新載入收件人列表（確保每次寄送使用最新的收件人設定）
+            self.recipients = self._load_recipients()
+            posts = digest.posts
+            sent = self.send_notification(posts, digest.fragments)
+            
+            if sent:
+                finished, claimed = posts, True
+                digest.clear()
+            else:
+                # 失敗時保留在摘要中，下次沿用已渲染的片段重寄
+                finished, claimed = digest.record_failure(), False
+            
+            if self.state_store:
+                for post in finished:
+                    if claimed:
+                        self.state_store.complete_claim(self._notification_key(post))
+                    else:
+                        self.state_store.release_claim(self._notification_key(post))
+            digest.save()
+            return sent
+    
     def fetch_posts(self):
         """使用增強版的爬蟲功能抓取Truth Social的貼文"""
         logger.info("開始抓取貼文...")
         
         try:
+            self._enter_phase("browser")
             with sync_playwright() as p:
                 # 使用更擬人化的瀏覽器設定
                 browser = p.chromium.launch(
                     headless=True,
+                    timeout=self._timeout_ms(30000),
                     args=[
                         '--disable-blink-features=AutomationControlled',
                         '--disable-features=IsolateOrigins,site-per-process',
@@ -294,7 +697,13 @@ class TruthSocialMonitor:
                     ]
                 )
                 
-                context = browser.new_context(
+                # 還原上次通過 Cloudflare 檢查的工作階段
+                storage_state = self._load_storage_state()
+                
+                # 依網路模式（直接連線/錄製/重播）建立 context
+                context = netreplay.new_context(
+                    browser,
+                    storage_state=storage_state,
                     viewport={"width": 1920, "height": 1080},
                     user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36",
                     locale="en-US",
@@ -339,6 +748,8 @@ class TruthSocialMonitor:
                 """)
                 
                 page = context.new_page()
+                if self.cycle_budget:
+                    page.set_default_timeout(self.cycle_budget.timeout_ms())
                 
                 # 模擬真實用戶行為
                 # 先訪問一個常見網站，然後再訪問目標網站
@@ -355,8 +766,9 @@ class TruthSocialMonitor:
                     pass
                 
                 # 使用更加人性化的方式訪問目標網站
+                self._enter_phase("navigation", page)
                 logger.info(f"訪問 {TRUTH_SOCIAL_URL}")
-                page.goto(TRUTH_SOCIAL_URL, wait_until="domcontentloaded", timeout=60000)
+                page.goto(TRUTH_SOCIAL_URL, wait_until="domcontentloaded", timeout=self._timeout_ms(60000))
                 
                 # 隨機等待以模擬人類行為
                 wait_time = 3000 + (1000 * (2 * (random.random() - 0.5)))
@@ -366,7 +778,7 @@ class TruthSocialMonitor:
                 page.mouse.move(random.randint(100, 700), random.randint(100, 500))
                 
                 # 等待更長時間讓頁面完全加載
-                page.wait_for_load_state("networkidle", timeout=60000)
+                page.wait_for_load_state("networkidle", timeout=self._timeout_ms(60000))
                 logger.info("頁面已加載，等待內容顯示...")
                 
                 # 保存初始頁面截圖
@@ -383,14 +795,22 @@ class TruthSocialMonitor:
                     pass
                 
                 # 檢查是否遇到 Cloudflare 挑戰頁面
-                if "Cloudflare" in page.title():
-                    logger.warning("遇到 Cloudflare 挑戰頁面，嘗試等待更長時間...")
+                if self._is_cloudflare_challenge(page):
+                    logger.warning("遇到 Cloudflare 挑戰頁面，等待挑戰完成...")
                     # 保存 Cloudflare 頁面以供分析
                     page.screenshot(path=os.path.join(DEBUG_DIR, "cloudflare_challenge.png"))
-                    # 等待更長時間允許 Cloudflare 檢查完成
-                    page.wait_for_timeout(30000)  # 等待 30 秒
+                    if self._wait_for_cloudflare_clearance(page):
+                        logger.info("已通過 Cloudflare 挑戰")
+                        self._save_storage_state(context)
+                    else:
+                        logger.warning(f"等待 {CLOUDFLARE_TIMEOUT_SECONDS} 秒後仍未通過 Cloudflare 挑戰")
+                        self._discard_storage_state()
+                elif storage_state is None or self._cookies_changed(context, storage_state):
+                    # 新的工作階段或通行證/工作階段 cookie 已更新（例如 cf_clearance 續期）時才保存
+                    self._save_storage_state(context)
                 
                 # 收集初始頁面的貼文
+                self._enter_phase("extraction", page)
                 initial_posts = self._extract_posts_from_page(page, "initial")
                 logger.info(f"初始頁面找到 {len(initial_posts)} 個貼文")
                 
@@ -417,6 +837,8 @@ class TruthSocialMonitor:
                 with open(os.path.join(DEBUG_DIR, "final_page.html"), "w", encoding="utf-8") as f:
                     f.write(page.content())
                 
+                # 先關閉 context，錄製模式才會寫出 HAR
+                context.close()
                 browser.close()
                 
                 # 使用 Jaccard 相似度去重
@@ -432,67 +854,139 @@ class TruthSocialMonitor:
             logger.error(f"爬蟲過程中發生嚴重錯誤: {str(e)}")
             return []
     
-    def check_and_notify(self):
-        """檢查新貼文並發送通知"""
-        try:
-            # 重新載入收件人列表（確保每次檢查使用最新的收件人設定）
-            self.recipients = self._load_recipients()
+    def _select_new_posts(self, posts):
+        """找出尚未通知過的貼文，並更新已通知記錄"""
+        new_posts = []
+        # 從已通知記錄中提取所有內容用於相似度檢查
+        existing_contents = [post_info.get("content", "") for post_info in self.seen_posts.values()]
+        existing_hashes = {self._content_hash(content) for content in existing_contents}
+        existing_media = set()
+        for post_info in self.seen_posts.values():
+            existing_media.update(self._media_keys(post_info))
+        
+        logger.info(f"比對 {len(posts)} 個新抓取貼文與 {len(existing_contents)} 個已通知貼文")
+        
+        for post in posts:
+            post_content = post.get("content", "")
+            post_id = post.get("id", "")
             
-            posts = self.fetch_posts()
+            media_only = self._is_media_only(post)
             
-            # 找出新貼文
-            new_posts = []
-            # 從已通知記錄中提取所有內容用於相似度檢查
-            existing_contents = [post_info.get("content", "") for post_info in self.seen_posts.values()]
+            # 跳過太短且沒有媒體的內容
+            if len(post_content) < MIN_TEXT_LENGTH and not media_only:
+                logger.info(f"跳過太短的貼文: {post_content}...")
+                continue
+                
+            # 檢查ID是否已存在（精確匹配）
+            if post_id in self.seen_posts:
+                logger.info(f"跳過已通知的貼文ID: {post_id}")
+                continue
             
-            logger.info(f"比對 {len(posts)} 個新抓取貼文與 {len(existing_contents)} 個已通知貼文")
+            # 純媒體貼文以媒體網址判斷是否已通知過
+            if media_only:
+                media_keys = self._media_keys(post)
+                if all(key in existing_media or f"media:{key}" in self.seen_filter for key in media_keys):
+                    logger.info(f"跳過已通知的媒體貼文: {post_content[:50]}...")
+                    continue
             
-            for post in posts:
-                post_content = post.get("content", "")
-                post_id = post.get("id", "")
+            # 檢查是否為去重窗口之外的舊貼文（精確匹配內容）
+            elif self._content_hash(post_content) in self.seen_filter:
+                logger.info(f"跳過去重窗口之外的舊貼文: {post_content[:50]}...")
+                continue
                 
-                # 跳過太短的內容
-                if len(post_content) < 100:
-                    # 比方說純影片的內容
-                    logger.info(f"跳過太短的貼文: {post_content}...")
+            # 使用 Jaccard 相似度檢查內容是否相似（模糊匹配）
+            elif self._is_similar_content(post_content, existing_contents):
+                logger.info(f"跳過相似內容貼文: {post_content[:50]}...")
+                # 每次檢查都會再看到仍在頁面上的貼文，相同內容只記錄一次
+                content_hash = self._content_hash(post_content)
+                if content_hash in existing_hashes:
                     continue
-                    
-                # 檢查ID是否已存在（精確匹配）
-                if post_id in self.seen_posts:
-                    logger.info(f"跳過已通知的貼文ID: {post_id}")
-                    continue
-                    
-                # 使用 Jaccard 相似度檢查內容是否相似（模糊匹配）
-                if self._is_similar_content(post_content, existing_contents):
-                    logger.info(f"跳過相似內容貼文: {post_content[:50]}...")
-                    # 仍然記錄這個ID以避免未來再次檢查
-                    self.seen_posts[post_id] = {
-                        "content": post_content,
-                        "date": post.get("date", "unknown"),
-                        "notified_at": "skipped_similar",
-                        "skipped_at": datetime.now().isoformat()
-                    }
-                    continue
-                
-                # 這是新貼文，添加到通知列表
-                new_posts.append(post)
+                existing_hashes.add(content_hash)
                 self.seen_posts[post_id] = {
                     "content": post_content,
+                    "media": post.get("media", []),
                     "date": post.get("date", "unknown"),
-                    "notified_at": datetime.now().isoformat()
+                    "published_at": post.get("published_at"),
+                    "notified_at": "skipped_similar",
+                    "skipped_at": datetime.now().isoformat()
                 }
+                continue
             
-            # 所有新貼文整合到一封郵件中發送
-            notification_sent = False
+            # 這是新貼文，添加到通知列表
+            new_posts.append(post)
+            existing_media.update(self._media_keys(post))
+            self.seen_posts[post_id] = {
+                "content": post_content,
+                "media": post.get("media", []),
+                "date": post.get("date", "unknown"),
+                "published_at": post.get("published_at"),
+                "notified_at": datetime.now().isoformat()
+            }
+        
+        return new_posts
+    
+    def check_and_notify(self, budget=None):
+        """檢查新貼文並發送通知，budget 為本次檢查的時間預算"""
+        self.cycle_budget = budget
+        try:
+            if not self._is_active():
+                logger.info(f"副本 {REPLICA_ID} 待命中，略過本次檢查")
+                return
+            
+            # 重新載入收件人列表（確保每次檢查使用最新的收件人設定）
+            self.recipients = self._load_recipients()
+            
+            if self.state_store:
+                # 其他副本可能已更新共用的去重狀態
+                self._load_dedup_state()
+            
+            posts = self.fetch_posts()
+            
+            # 找出新貼文
+            new_posts = self._select_new_posts(posts)
+            
+            # 認領通知，避免多個副本重複寄送
+            if self.state_store and new_posts:
+                new_posts = self._claim_posts(new_posts)
+            
+            # 新貼文加入摘要，合併窗口到期時整合到一封郵件中發送
+            self._enter_phase("notify")
             if new_posts:
-                notification_sent = self.send_notification(new_posts)
+                with digest_lock():
+                    digest = NotificationDigest()
+                    digest.add(new_posts)
+                    digest.save()
+            
+            # 已失去主要抓取者身分時不寫入共用狀態，避免覆蓋新的主要抓取者
+            if self.state_store and not self._is_active():
+                logger.warning("檢查期間失去主要抓取者身分，不保存去重狀態")
+                return
             
-            # 保存已通知貼文
+            # 寄送前先保存已通知貼文（超出去重窗口的貼文移入 Bloom filter），
+            # 寄送後才當掉時，接手的副本不會把同一批貼文再當成新貼文
+            self._compact_seen_posts()
             self._save_seen_posts()
             
+            notification_sent = self.flush_digest()
+            
+            if self.state_store:
+                self.state_store.set_meta("last_check_at", time.time())
+                self.state_store.prune_claims(max(DEDUP_WINDOW_DAYS, 1) * 86400)
+            
+            # 將新貼文加入搜尋索引
             if new_posts:
-                status = "成功" if notification_sent else "失敗"
-                logger.info(f"發現 {len(new_posts)} 個新貼文，發送整合通知 {status}")
+                indexed = self.search_index.add_posts(new_posts)
+                logger.info(f"已將 {indexed} 則貼文加入搜尋索引")
+            
+            # 重新載入寄送後的摘要狀態
+            digest = NotificationDigest()
+            if notification_sent:
+                logger.info(f"發現 {len(new_posts)} 個新貼文，已發送整合通知")
+            elif len(digest) and not digest.is_due():
+                due_at = datetime.fromtimestamp(digest.due_at()).strftime('%H:%M')
+                logger.info(f"發現 {len(new_posts)} 個新貼文，摘要共 {len(digest)} 則，將在 {due_at} 寄出")
+            elif new_posts or len(digest):
+                logger.info(f"發現 {len(new_posts)} 個新貼文，發送整合通知失敗")
             else:
                 logger.info("沒有發現新貼文")
                 
@@ -500,6 +994,10 @@ class TruthSocialMonitor:
             logger.error(f"檢查過程出錯: {str(e)}")
             import traceback
             logger.error(traceback.format_exc())
+        finally:
+            if budget:
+                logger.info(f"各階段耗時（秒）: {budget.finish()}")
+            self.cycle_budget = None
 
     def _load_recipients(self):
         """從檔案中載入收件人列表"""
@@ -537,25 +1035,77 @@ class TruthSocialMonitor:
             
         return recipients
 
+def run_cycle(budget_seconds):
+    """在受監督的子行程中執行一次檢查"""
+    monitor = TruthSocialMonitor()
+    monitor.check_and_notify(CycleBudget(budget_seconds))
+
+def run_flush(budget_seconds):
+    """在受監督的子行程中寄出到期的摘要，下載媒體與寄送郵件都在預算內完成"""
+    monitor = TruthSocialMonitor()
+    monitor.cycle_budget = CycleBudget(budget_seconds, shares=(("notify", 1.0),))
+    monitor._enter_phase("notify")
+    monitor.flush_digest()
+    logger.info(f"摘要寄送耗時: {monitor.cycle_budget.finish()}")
+
 def main():
     """主函數，設置定時任務"""
     monitor = TruthSocialMonitor()
+    # 每次檢查都在獨立行程中執行，卡住時連同瀏覽器一併終止
+    supervisor = CycleSupervisor(run_cycle)
+    # 兩次檢查之間的摘要寄送同樣在有預算的子行程中執行，不會拖延主迴圈
+    flush_supervisor = CycleSupervisor(run_flush, DIGEST_FLUSH_BUDGET_SECONDS,
+                                       metrics_file=DIGEST_FLUSH_METRICS_FILE, name="摘要寄送")
+    
+    # 高可用模式：以租約選出唯一負責抓取的副本
+    elector = None
+    if monitor.state_store:
+        elector = LeaderElector(monitor.state_store, REPLICA_ID, HA_LEASE_SECONDS)
+        elector.start()
+        elector.consume_election()
+        logger.info(f"高可用模式已啟用，副本 {REPLICA_ID} {'為主要抓取者' if elector.is_leader else '待命中'}")
     
     # 首次啟動立即執行一次
-    monitor.check_and_notify()
+    supervisor.start_cycle()
+    
+    # 在兩次檢查之間寄出到期的摘要（檢查進行中時由檢查行程負責）
+    def flush_digest():
+        if supervisor.running or flush_supervisor.running:
+            return
+        if elector and not elector.is_leader:
+            return
+        if NotificationDigest().is_due():
+            flush_supervisor.start_cycle()
     
     # 定義檢查函式
     def scheduled_check():
-        monitor.check_and_notify()
+        if elector and not elector.is_leader:
+            logger.info(f"副本 {REPLICA_ID} 待命中，略過本次檢查")
+            return
+        supervisor.start_cycle()
 
     # 設置定時任務：每小時的第01分鐘執行
     schedule.every().hour.at(":01").do(scheduled_check)
+    if DIGEST_WINDOW_MINUTES > 0:
+        schedule.every(1).minutes.do(flush_digest)
 
     logger.info("監控服務已啟動，將在每小時的第01分鐘執行檢查")
     
     # 保持程序運行並執行定時任務
     while True:
         schedule.run_pending()
+        
+        # 接手時若上一個主要抓取者錯過了檢查，立即補做一次
+        if elector and elector.consume_election():
+            last_check_at = float(monitor.state_store.get_meta("last_check_at", 0))
+            if time.time() - last_check_at > 3600:
+                logger.info("接手主要抓取者，上次檢查已超過一小時，立即執行檢查")
+                supervisor.start_cycle()
+        
+        # 處理已結束或超出預算的檢查與摘要寄送
+        supervisor.poll()
+        flush_supervisor.poll()
+        
         time.sleep(1)
 
 if __name__ == "__main__":
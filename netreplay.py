@@ -0,0 +1,217 @@
+import argparse
+import base64
+import json
+import logging
+import random
+import time
+from collections import deque
+
+from config import NETWORK_ARCHIVE, NETWORK_MODE, NETWORK_PROFILE
+
+logger = logging.getLogger(__name__)
+
+# 網路條件設定：每個請求的延遲與頻寬（kbps，None 表示不限制）
+PROFILES = {
+    "none": {"latency_ms": 0, "kbps": None},
+    "dsl": {"latency_ms": 50, "kbps": 8000},
+    "4g": {"latency_ms": 80, "kbps": 9000},
+    "fast3g": {"latency_ms": 150, "kbps": 1600},
+    "slow3g": {"latency_ms": 400, "kbps": 400},
+}
+
+# 重播時不能沿用的標頭（內容已解壓縮、長度可能不同）
+_DROPPED_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+
+_settings = {
+    "mode": NETWORK_MODE,
+    "archive": NETWORK_ARCHIVE,
+    "profile": NETWORK_PROFILE,
+}
+
+
+def configure(mode=None, archive=None, profile=None):
+    """在程式中切換網路模式（預設值來自環境變數）"""
+    if mode is not None:
+        _settings["mode"] = mode
+    if archive is not None:
+        _settings["archive"] = archive
+    if profile is not None:
+        _settings["profile"] = profile
+
+
+def is_replaying():
+    """目前是否為重播模式"""
+    return _settings["mode"] == "replay"
+
+
+class ReplayRouter:
+    """從 HAR 檔重播回應的 Playwright route handler
+
+    相同的請求依錄製順序回應，用完後重複最後一個回應；
+    找不到的請求會直接中止，不會連到網路。
+    注意：sync API 的 route handler 依序執行，延遲會依序累加。
+    """
+
+    def __init__(self, archive, profile="none"):
+        if profile not in PROFILES:
+            raise ValueError(f"未知的網路條件: {profile}，可用: {', '.join(PROFILES)}")
+        self.latency = PROFILES[profile]["latency_ms"] / 1000
+        self.kbps = PROFILES[profile]["kbps"]
+        self.responses = {}
+        self.fallbacks = {}
+        self.served = 0
+        self.missed = []
+
+        with open(archive, 'r', encoding='utf-8') as f:
+            har = json.load(f)
+        for entry in har["log"]["entries"]:
+            request = entry["request"]
+            key = (request["method"], request["url"])
+            self.responses.setdefault(key, deque()).append(entry["response"])
+            # 查詢參數不同（例如防快取參數）時的備用對應
+            self.fallbacks.setdefault((request["method"], request["url"].split("?")[0]), entry["response"])
+        logger.info(f"已載入 {len(har['log']['entries'])} 個錄製的請求 (網路條件: {profile})")
+
+    def _next_response(self, method, url):
+        """取得下一個錄製的回應"""
+        queue = self.responses.get((method, url))
+        if queue:
+            return queue.popleft() if len(queue) > 1 else queue[0]
+        return self.fallbacks.get((method, url.split("?")[0]))
+
+    def __call__(self, route):
+        request = route.request
+        response = self._next_response(request.method, request.url)
+        if response is None:
+            self.missed.append(request.url)
+            route.abort("internetdisconnected")
+            return
+
+        content = response.get("content", {})
+        text = content.get("text", "")
+        if content.get("encoding") == "base64":
+            body = base64.b64decode(text)
+        else:
+            body = text.encode("utf-8")
+
+        delay = self.latency
+        if self.kbps:
+            delay += len(body) * 8 / (self.kbps * 1000)
+        if delay:
+            time.sleep(delay)
+
+        headers = {
+            header["name"]: header["value"]
+            for header in response.get("headers", [])
+            if header["name"].lower() not in _DROPPED_HEADERS
+        }
+        self.served += 1
+        route.fulfill(status=response["status"], headers=headers, body=body)
+
+
+def new_context(browser, **kwargs):
+    """依網路模式建立 browser context
+
+    record 模式在 context 關閉時寫出 HAR，因此呼叫端需要在關閉瀏覽器前先關閉 context。
+    錄製與重播時都會停用 service worker，否則它發出的請求不會經過 route，也不會被錄進 HAR。
+    WebSocket 不會被錄製或重播。
+    """
+    mode = _settings["mode"]
+    if mode == "record":
+        logger.info(f"錄製網路流量到 {_settings['archive']}")
+        return browser.new_context(record_har_path=_settings["archive"], record_har_content="embed",
+                                   service_workers="block", **kwargs)
+
+    if mode == "replay":
+        kwargs["service_workers"] = "block"
+    context = browser.new_context(**kwargs)
+    if mode == "replay":
+        logger.info(f"從 {_settings['archive']} 重播網路流量")
+        context.route("**/*", ReplayRouter(_settings["archive"], _settings["profile"]))
+    elif mode != "live":
+        raise ValueError(f"未知的網路模式: {mode}")
+    return context
+
+
+def _match_rate(posts, reference, monitor, threshold=0.9):
+    """計算 posts 中有多少比例能在 reference 找到相似內容"""
+    if not posts:
+        return 0.0
+    matched = 0
+    for post in posts:
+        content = post.get("content", "")
+        if any(monitor._calculate_jaccard_similarity(content, ref.get("content", "")) >= threshold
+               for ref in reference):
+            matched += 1
+    return matched / len(posts)
+
+
+def record(monitor, archive):
+    """錄製一次完整的抓取流程，並保存抓到的貼文作為重播時的比對基準"""
+    configure(mode="record", archive=archive)
+    posts = monitor.fetch_posts()
+    with open(f"{archive}.posts.json", 'w', encoding='utf-8') as f:
+        json.dump(posts, f, ensure_ascii=False, indent=2)
+    logger.info(f"已錄製 {len(posts)} 個貼文到 {archive}")
+
+
+def bench(monitor, archive, profile="none", runs=3, seed=0):
+    """重播錄製的流程數次，量測完整週期耗時、擷取準確度與去重行為"""
+    from bloom import BloomFilter
+
+    configure(mode="replay", archive=archive, profile=profile)
+    with open(f"{archive}.posts.json", 'r', encoding='utf-8') as f:
+        expected = json.load(f)
+
+    # 使用空白的去重狀態，不影響正式資料
+    monitor.seen_posts = {}
+    monitor.seen_filter = BloomFilter()
+
+    results = []
+    for run in range(1, runs + 1):
+        random.seed(seed)
+        start = time.perf_counter()
+        posts = monitor.fetch_posts()
+        elapsed = time.perf_counter() - start
+        new_posts = monitor._select_new_posts(posts)
+        results.append({
+            "run": run,
+            "seconds": round(elapsed, 2),
+            "posts": len(posts),
+            "precision": round(_match_rate(posts, expected, monitor), 3),
+            "recall": round(_match_rate(expected, posts, monitor), 3),
+            "new_posts": len(new_posts),
+        })
+        logger.info(f"第 {run} 次重播: {results[-1]}")
+    return results
+
+
+def main():
+    """錄製或重播 fetch_posts 的完整流程"""
+    parser = argparse.ArgumentParser(description="錄製/重播 Truth Social 網路流量，用於離線測試與效能量測")
+    parser.add_argument("command", choices=["record", "bench"])
+    parser.add_argument("--archive", default=_settings["archive"], help="HAR 檔路徑")
+    parser.add_argument("--profile", default=_settings["profile"], choices=list(PROFILES), help="重播時的網路條件")
+    parser.add_argument("--runs", type=int, default=3, help="重播次數")
+    parser.add_argument("--seed", type=int, default=0, help="隨機等待時間的種子")
+    args = parser.parse_args()
+
+    from monitor import TruthSocialMonitor
+    monitor = TruthSocialMonitor()
+
+    if args.command == "record":
+        record(monitor, args.archive)
+        return
+
+    results = bench(monitor, args.archive, args.profile, args.runs, args.seed)
+    print(f"\n網路條件: {args.profile}")
+    print(f"{'次數':<6}{'秒數':>8}{'貼文':>6}{'精確率':>8}{'召回率':>8}{'新貼文':>8}")
+    for result in results:
+        print(f"{result['run']:<6}{result['seconds']:>8}{result['posts']:>6}"
+              f"{result['precision']:>8}{result['recall']:>8}{result['new_posts']:>8}")
+
+
+if __name__ == "__main__":
+    # 以模組方式匯入，讓 monitor 與命令列共用同一份網路模式設定
+    import netreplay
+    netreplay.main()
@@ -0,0 +1,345 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime
+
+from config import DATA_FILE, SEARCH_INDEX_FILE
+
+logger = logging.getLogger(__name__)
+
+# 與 Jaccard 相似度相同的斷詞規則
+TOKEN_PATTERN = re.compile(r'\w+')
+
+# 最稀有的單詞出現在不超過這麼多則貼文時，先取出候選貼文再逐一比對；
+# 否則（例如每則貼文都有的 trump）改為依時間由新到舊逐則檢查，找滿 limit 筆即停止
+CANDIDATE_LIMIT = 5000
+# 單一 SQL 查詢中 IN (...) 的參數數量上限
+BATCH_SIZE = 500
+
+
+def tokenize(text):
+    """將文字轉為小寫單詞列表（與 Jaccard 相似度共用）"""
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def _parse_timestamp(value):
+    """嘗試將字串解析為 ISO 時間，失敗則回傳 None"""
+    if not value or not isinstance(value, str):
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=None).isoformat()
+    except ValueError:
+        return None
+
+
+def _post_timestamp(post):
+    """取得貼文可排序的時間，依序嘗試 <time datetime> 發布時間、抓取時間與通知時間
+
+    date 通常是「3h」之類的相對時間，只有在它剛好是 ISO 格式時才會用到。
+    """
+    for key in ("published_at", "date", "crawled_at", "notified_at", "skipped_at"):
+        timestamp = _parse_timestamp(post.get(key))
+        if timestamp:
+            return timestamp
+    return datetime.now().isoformat()
+
+
+def content_key(content):
+    """以斷詞結果計算內容雜湊，用於略過完全相同的內容"""
+    return hashlib.sha1(" ".join(tokenize(content)).encode("utf-8")).hexdigest()
+
+
+class PostIndex:
+    """貼文的增量倒排索引（單詞 → 貼文與出現位置），保存在 SQLite 中
+
+    查詢時先讀取各單詞的文件頻率，只載入最稀有單詞的 posting list，
+    其他單詞與片語位置只針對候選貼文查詢；時間範圍則透過 timestamp 索引查詢。
+    """
+
+    def __init__(self, index_file=SEARCH_INDEX_FILE):
+        self.index_file = index_file
+        self._conn = None
+
+    def _connect(self):
+        """開啟資料庫並建立資料表"""
+        if self._conn is None:
+            directory = os.path.dirname(self.index_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.index_file, timeout=30)
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS docs (
+                    doc INTEGER PRIMARY KEY,
+                    id TEXT NOT NULL UNIQUE,
+                    key TEXT NOT NULL UNIQUE,
+                    content TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    timestamp TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS docs_timestamp ON docs (timestamp);
+                CREATE TABLE IF NOT EXISTS postings (
+                    token TEXT NOT NULL,
+                    doc INTEGER NOT NULL,
+                    positions TEXT NOT NULL,
+                    PRIMARY KEY (token, doc)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS terms (
+                    token TEXT PRIMARY KEY,
+                    df INTEGER NOT NULL
+                ) WITHOUT ROWID;
+            """)
+            # 舊版索引沒有文件頻率表，從 postings 補上
+            conn = self._conn
+            if (conn.execute("SELECT 1 FROM terms LIMIT 1").fetchone() is None
+                    and conn.execute("SELECT 1 FROM postings LIMIT 1").fetchone() is not None):
+                with conn:
+                    conn.execute("INSERT INTO terms (token, df) SELECT token, COUNT(*) FROM postings GROUP BY token")
+        return self._conn
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def add_posts(self, posts):
+        """增量加入貼文，重複的ID或內容會被略過，回傳實際新增的數量"""
+        conn = self._connect()
+        added = 0
+        with conn:
+            for post in posts:
+                post_id = post.get("id")
+                content = post.get("content", "")
+                if not post_id or not content:
+                    continue
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO docs (id, key, content, date, timestamp) VALUES (?, ?, ?, ?, ?)",
+                    (post_id, content_key(content), content, post.get("date", "unknown"), _post_timestamp(post))
+                )
+                if cursor.rowcount == 0:
+                    continue
+                positions = {}
+                for position, token in enumerate(tokenize(content)):
+                    positions.setdefault(token, []).append(str(position))
+                conn.executemany(
+                    "INSERT INTO postings (token, doc, positions) VALUES (?, ?, ?)",
+                    [(token, cursor.lastrowid, " ".join(p)) for token, p in positions.items()]
+                )
+                conn.executemany(
+                    "INSERT INTO terms (token, df) VALUES (?, 1) ON CONFLICT(token) DO UPDATE SET df = df + 1",
+                    [(token,) for token in positions]
+                )
+                added += 1
+        return added
+
+    def _document_frequencies(self, terms):
+        """讀取各單詞出現在幾則貼文中"""
+        terms = list(terms)
+        placeholders = ", ".join("?" * len(terms))
+        rows = self._connect().execute(f"SELECT token, df FROM terms WHERE token IN ({placeholders})", terms)
+        frequencies = dict(rows.fetchall())
+        return {term: frequencies.get(term, 0) for term in terms}
+
+    def _postings_for(self, token, docs):
+        """讀取單詞在指定貼文中的出現位置: {文件編號: 位置字串}"""
+        docs = list(docs)
+        postings = {}
+        for i in range(0, len(docs), BATCH_SIZE):
+            batch = docs[i:i + BATCH_SIZE]
+            placeholders = ", ".join("?" * len(batch))
+            rows = self._connect().execute(
+                f"SELECT doc, positions FROM postings WHERE token = ? AND doc IN ({placeholders})",
+                [token] + batch
+            )
+            postings.update(rows.fetchall())
+        return postings
+
+    def _match_phrase(self, terms, docs):
+        """以位置資訊過濾出連續出現該片語的文件（只讀取 docs 的位置資訊）"""
+        matched = set(docs)
+        starts = {}
+        for offset, term in enumerate(terms):
+            if not matched:
+                break
+            postings = self._postings_for(term, matched)
+            for doc in list(matched):
+                positions = {int(p) - offset for p in postings.get(doc, "").split()}
+                starts[doc] = positions if offset == 0 else starts[doc] & positions
+                if not starts[doc]:
+                    matched.discard(doc)
+        return matched
+
+    def _match_phrases(self, phrase_terms, docs):
+        """過濾出包含所有片語的文件"""
+        for terms in phrase_terms:
+            if len(terms) > 1 and docs:
+                docs = self._match_phrase(terms, docs)
+        return docs
+
+    def search(self, query="", phrases=(), since=None, until=None, limit=20):
+        """搜尋貼文
+
+        query 中的單詞必須全部出現，以雙引號包住的部分視為片語；
+        since / until 為 ISO 日期字串，用於限制時間範圍。
+        """
+        conn = self._connect()
+        phrases = list(phrases) + re.findall(r'"([^"]+)"', query)
+        keywords = tokenize(re.sub(r'"[^"]*"', " ", query))
+        phrase_terms = [tokenize(phrase) for phrase in phrases]
+        phrase_terms = [terms for terms in phrase_terms if terms]
+
+        since = _parse_timestamp(since) if since else None
+        if until and len(until) == 10:
+            # 只有日期時包含當天整天
+            until = f"{until}T23:59:59.999999"
+        until = _parse_timestamp(until) if until else None
+        conditions, params = [], []
+        if since:
+            conditions.append("timestamp >= ?")
+            params.append(since)
+        if until:
+            conditions.append("timestamp <= ?")
+            params.append(until)
+
+        all_terms = set(keywords) | {term for terms in phrase_terms for term in terms}
+        if all_terms:
+            frequencies = self._document_frequencies(all_terms)
+            ordered = sorted(all_terms, key=frequencies.get)
+            if frequencies[ordered[0]] == 0:
+                return []
+
+            if frequencies[ordered[0]] > CANDIDATE_LIMIT:
+                # 所有單詞都很常見：依時間由新到舊檢查，找滿 limit 筆即停止
+                return self._scan_recent(ordered, phrase_terms, conditions, params, limit)
+
+            # 只載入最稀有單詞的貼文，其他單詞只在候選貼文中查詢
+            candidates = [row[0] for row in conn.execute("SELECT doc FROM postings WHERE token = ?", (ordered[0],))]
+            for term in ordered[1:]:
+                if not candidates:
+                    break
+                candidates = list(self._postings_for(term, candidates))
+            candidates = self._match_phrases(phrase_terms, set(candidates))
+            if not candidates:
+                return []
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS candidates (doc INTEGER PRIMARY KEY)")
+            conn.execute("DELETE FROM candidates")
+            conn.executemany("INSERT INTO candidates (doc) VALUES (?)", ((doc,) for doc in candidates))
+            conditions.append("doc IN (SELECT doc FROM candidates)")
+
+        sql = "SELECT id, content, date, timestamp FROM docs"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        # timestamp 有索引，時間範圍與排序不需要掃描全部文件
+        sql += " ORDER BY timestamp DESC"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        rows = conn.execute(sql, params).fetchall()
+        return [{"id": row[0], "content": row[1], "date": row[2], "timestamp": row[3]} for row in rows]
+
+    def _scan_recent(self, terms, phrase_terms, conditions, params, limit):
+        """沿 timestamp 索引由新到舊逐批檢查貼文，適用於沒有稀有單詞的查詢"""
+        conn = self._connect()
+        # 片語中的單詞在比對位置時就會檢查，不需要另外用 EXISTS 過濾
+        in_phrases = {term for phrase in phrase_terms for term in phrase}
+        keyword_terms = [term for term in terms if term not in in_phrases]
+        conditions = conditions + ["EXISTS (SELECT 1 FROM postings WHERE token = ? AND postings.doc = docs.doc)"] * len(keyword_terms)
+        sql = "SELECT doc FROM docs"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        # 只走 timestamp 索引取得文件編號，內容等符合後才讀取
+        cursor = conn.execute(sql + " ORDER BY timestamp DESC", list(params) + keyword_terms)
+
+        matched = []
+        # 先取少量，符合的貼文很少時逐步加大批次，減少查詢次數
+        batch_size = max(limit * 2, 1) if limit else BATCH_SIZE
+        while not limit or len(matched) < limit:
+            docs = [row[0] for row in cursor.fetchmany(batch_size)]
+            if not docs:
+                break
+            batch_size = min(batch_size * 2, CANDIDATE_LIMIT)
+            found = self._match_phrases(phrase_terms, set(docs))
+            matched.extend(doc for doc in docs if doc in found)
+        if limit:
+            matched = matched[:limit]
+
+        results = []
+        for i in range(0, len(matched), BATCH_SIZE):
+            batch = matched[i:i + BATCH_SIZE]
+            placeholders = ", ".join("?" * len(batch))
+            rows = conn.execute(
+                f"SELECT id, content, date, timestamp FROM docs WHERE doc IN ({placeholders}) ORDER BY timestamp DESC",
+                batch
+            )
+            results.extend({"id": row[0], "content": row[1], "date": row[2], "timestamp": row[3]} for row in rows)
+        return results
+
+    def rebuild(self, sources, force=False):
+        """從既有的資料檔補回索引中缺少的貼文
+
+        seen_posts.json 只保留去重窗口內的貼文，爬蟲輸出每次都會覆寫，
+        索引是唯一的長期封存，因此預設只新增不刪除；force=True 才會先清空索引。
+        """
+        conn = self._connect()
+        if force:
+            logger.warning(f"清空搜尋索引 {self.index_file}，資料檔以外的已封存貼文將會遺失")
+            with conn:
+                conn.execute("DELETE FROM postings")
+                conn.execute("DELETE FROM terms")
+                conn.execute("DELETE FROM docs")
+        for source in sources:
+            if not os.path.exists(source):
+                continue
+            with open(source, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                # seen_posts.json 格式: {貼文ID: 貼文資訊}
+                posts = [dict(info, id=post_id) for post_id, info in data.items()]
+            else:
+                posts = data
+            added = self.add_posts(posts)
+            logger.info(f"從 {source} 加入 {added} 則貼文")
+
+
+def main():
+    """命令列搜尋介面"""
+    parser = argparse.ArgumentParser(description="搜尋已封存的 Truth Social 貼文")
+    parser.add_argument("query", nargs="?", default="", help='關鍵字，以雙引號包住的部分視為片語')
+    parser.add_argument("--phrase", action="append", default=[], help="必須連續出現的片語，可重複指定")
+    parser.add_argument("--since", help="起始時間 (ISO 格式，例如 2025-01-01)")
+    parser.add_argument("--until", help="結束時間 (ISO 格式)")
+    parser.add_argument("--limit", type=int, default=20, help="最多顯示幾筆結果，0 表示全部")
+    parser.add_argument("--index", default=SEARCH_INDEX_FILE, help="索引檔路徑")
+    parser.add_argument("--rebuild", nargs="*", metavar="FILE",
+                        help="從資料檔補回索引中缺少的貼文（預設為已通知貼文與爬蟲輸出）")
+    parser.add_argument("--force", action="store_true",
+                        help="搭配 --rebuild 使用：先清空索引再重建（會遺失資料檔中已不存在的貼文）")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    index = PostIndex(args.index)
+    if args.rebuild is not None:
+        sources = args.rebuild or [DATA_FILE, os.path.join("data", "truth_social_posts.json")]
+        index.rebuild(sources, force=args.force)
+        # 重建後重新開啟，計時才包含開啟索引的成本
+        index = PostIndex(args.index)
+
+    start = time.perf_counter()
+    results = index.search(args.query, phrases=args.phrase, since=args.since,
+                           until=args.until, limit=args.limit)
+    total = len(index)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    print(f"\n在 {total} 則貼文中找到 {len(results)} 筆結果 ({elapsed_ms:.1f} ms):\n")
+    for doc in results:
+        print(f"--- {doc['id']} ---")
+        print(f"日期: {doc['date']} ({doc['timestamp']})")
+        print(f"內容: {doc['content']}")
+        print("-" * 80)
+
+
+if __name__ == "__main__":
+    main()
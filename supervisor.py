@@ -0,0 +1,166 @@
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from datetime import datetime
+
+from config import CYCLE_BUDGET_SECONDS, CYCLE_KILL_GRACE_SECONDS, CYCLE_METRICS_FILE
+
+logger = logging.getLogger(__name__)
+
+# 各階段佔總預算的比例，依序執行，前一階段沒用完的時間會留給後面的階段
+PHASE_SHARES = (
+    ("browser", 0.2),      # 啟動瀏覽器與預熱
+    ("navigation", 0.35),  # 載入目標頁面與 Cloudflare 挑戰
+    ("extraction", 0.25),  # 滾動與擷取貼文
+    ("notify", 0.2),       # 下載媒體與寄送郵件
+)
+
+
+class CycleTimeout(Exception):
+    """檢查週期超出時間預算"""
+
+
+class CycleBudget:
+    """一次檢查週期的時間預算，依比例分配給各階段"""
+
+    def __init__(self, total_seconds=CYCLE_BUDGET_SECONDS, shares=PHASE_SHARES):
+        self.started_at = time.monotonic()
+        self.deadline = self.started_at + total_seconds
+        self.phase_deadlines = {}
+        elapsed_share = 0
+        for phase, share in shares:
+            elapsed_share += share
+            self.phase_deadlines[phase] = self.started_at + total_seconds * elapsed_share
+        self.phase = None
+        self.phase_started_at = self.started_at
+        self.durations = {}
+
+    def enter(self, phase):
+        """進入新階段，若該階段的截止時間已過則拋出 CycleTimeout"""
+        now = time.monotonic()
+        if self.phase:
+            self.durations[self.phase] = round(now - self.phase_started_at, 2)
+        self.phase = phase
+        self.phase_started_at = now
+        if now >= self.phase_deadlines.get(phase, self.deadline):
+            raise CycleTimeout(f"進入 {phase} 階段時已超出時間預算")
+
+    def timeout_ms(self):
+        """目前階段剩餘的毫秒數（至少 1 毫秒，Playwright 的 0 代表不逾時）"""
+        deadline = self.phase_deadlines.get(self.phase, self.deadline)
+        return max(1, int((deadline - time.monotonic()) * 1000))
+
+    def finish(self):
+        """結束最後一個階段，回傳各階段耗時"""
+        if self.phase:
+            self.durations[self.phase] = round(time.monotonic() - self.phase_started_at, 2)
+            self.phase = None
+        return self.durations
+
+
+def _cycle_entry(target, budget_seconds):
+    """子行程入口：建立新的行程群組，讓瀏覽器等子孫行程可以一併被終止"""
+    os.setsid()
+    target(budget_seconds)
+
+
+class CycleSupervisor:
+    """在獨立行程中執行檢查週期，超出預算時連同瀏覽器一併終止
+
+    主迴圈不會被卡住的檢查拖延，下一次檢查永遠可以準時開始。
+    """
+
+    def __init__(self, target, budget_seconds=CYCLE_BUDGET_SECONDS,
+                 grace_seconds=CYCLE_KILL_GRACE_SECONDS, metrics_file=CYCLE_METRICS_FILE, name="檢查週期"):
+        self.target = target
+        self.name = name
+        self.budget_seconds = budget_seconds
+        self.grace_seconds = grace_seconds
+        self.metrics_file = metrics_file
+        self._context = multiprocessing.get_context("spawn")
+        self._process = None
+        self._started_at = None
+        self.metrics = self._load_metrics()
+
+    def _load_metrics(self):
+        """載入累計的週期指標"""
+        if os.path.exists(self.metrics_file):
+            try:
+                with open(self.metrics_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except json.JSONDecodeError:
+                logger.error(f"無法解析 {self.metrics_file}，將重新計算指標")
+        return {"cycles_total": 0, "cycle_timeouts_total": 0, "cycle_failures_total": 0}
+
+    def _record(self, status, duration):
+        """記錄一次週期的結果"""
+        self.metrics["cycles_total"] += 1
+        if status == "timeout":
+            self.metrics["cycle_timeouts_total"] += 1
+            self.metrics["last_timeout_at"] = datetime.now().isoformat()
+        elif status == "failed":
+            self.metrics["cycle_failures_total"] += 1
+        self.metrics["last_cycle_status"] = status
+        self.metrics["last_cycle_seconds"] = round(duration, 2)
+        self.metrics["last_cycle_finished_at"] = datetime.now().isoformat()
+
+        directory = os.path.dirname(self.metrics_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_file = f"{self.metrics_file}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.metrics, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, self.metrics_file)
+
+        if status == "timeout":
+            logger.error(f"metric cycle_timeout_total={self.metrics['cycle_timeouts_total']} "
+                         f"duration={duration:.1f}s budget={self.budget_seconds}s")
+
+    @property
+    def running(self):
+        return self._process is not None and self._process.is_alive()
+
+    def _kill_process_group(self):
+        """終止子行程及其啟動的瀏覽器行程"""
+        try:
+            os.killpg(self._process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        self._process.join(timeout=5)
+
+    def start_cycle(self):
+        """開始新的檢查週期，若上一次仍在執行則先終止"""
+        if self.running:
+            logger.error(f"上一次{self.name}仍在執行，強制終止以準時開始新的{self.name}")
+            self._kill_process_group()
+            self._record("timeout", time.monotonic() - self._started_at)
+            self._process = None
+
+        self._process = self._context.Process(target=_cycle_entry, args=(self.target, self.budget_seconds))
+        self._started_at = time.monotonic()
+        self._process.start()
+        logger.info(f"開始{self.name} (pid {self._process.pid}，預算 {self.budget_seconds} 秒)")
+
+    def poll(self):
+        """由主迴圈定期呼叫：處理已結束或超出預算的週期"""
+        if self._process is None:
+            return
+        duration = time.monotonic() - self._started_at
+
+        if self._process.is_alive():
+            if duration > self.budget_seconds + self.grace_seconds:
+                logger.error(f"{self.name}執行 {duration:.0f} 秒，超出預算，終止{self.name}行程及其子行程")
+                self._kill_process_group()
+                self._record("timeout", duration)
+                self._process = None
+            return
+
+        # 正常結束時也清理殘留的瀏覽器行程
+        exitcode = self._process.exitcode
+        self._kill_process_group()
+        self._record("ok" if exitcode == 0 else "failed", duration)
+        logger.info(f"{self.name}結束，耗時 {duration:.1f} 秒 (exit code {exitcode})")
+        self._process = None